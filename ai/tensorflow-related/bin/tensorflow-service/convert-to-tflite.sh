@@ -0,0 +1,21 @@
+#!/bin/bash
+# A script to convert the model of the TensorFlow service to an INT8 TF-Lite model.
+
+if [ $# -lt 1 ]; then
+    echo "Usage: <representative-image-dir>"
+    exit 1
+fi
+
+CURRENT_DIR=`dirname "$0"`
+export TENSORFLOW_RELATED_HOME=`cd "$CURRENT_DIR/../.."; pwd`
+
+PYTHON_BIN=`which python3.5`
+if [ $? -ne 0 ]; then
+    echo "Python 3.5 not found, quit"
+    exit 1
+fi
+
+REPRESENTATIVE_IMAGE_DIR=$1
+
+# convert the model
+$PYTHON_BIN $TENSORFLOW_RELATED_HOME/bin/tensorflow-service/convert_to_tflite.py --model_dir $TENSORFLOW_RELATED_HOME/resource/model --representative_image_dir $REPRESENTATIVE_IMAGE_DIR
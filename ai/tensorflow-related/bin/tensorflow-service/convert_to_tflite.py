@@ -0,0 +1,89 @@
+"""Converts the Inception model to an INT8 quantized TF-Lite model.
+
+The batched and optimized graph of tensorflow_service.py is converted with
+full integer quantization, so that the convolutions run as int8 NEON kernels
+on the ARM CPU of Raspberry Pi. The input and output of the model stay
+float32, so the TensorFlow service can run it with the --tflite_model
+argument without any other change.
+
+The quantization ranges of the activations are calibrated with the jpg
+images in the --representative_image_dir directory, about 100 images similar
+to the ones to classify are enough.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os.path
+
+import tensorflow as tf
+
+import tensorflow_service
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('representative_image_dir', '',
+                           """Directory of jpg images used to calibrate """
+                           """the quantization.""")
+tf.app.flags.DEFINE_string(
+    'tflite_output_file', '',
+    """Path of the TF-Lite model to write, inception_int8.tflite in """
+    """--model_dir by default.""")
+
+
+def representative_dataset():
+  """Yields the normalized calibration images, one at a time."""
+  for image in tf.gfile.Glob(
+      os.path.join(FLAGS.representative_image_dir, '*.jpg')):
+    image_data = tf.gfile.FastGFile(image, 'rb').read()
+    yield [tensorflow_service.preprocess_image(image_data)]
+
+
+def convert_to_tflite():
+  """Converts the batched graph and returns the TF-Lite model.
+
+  The graph saved by optimize_graph() is used if it exists. Otherwise the
+  batched original graph is saved to --model_dir to be converted, as the
+  converter only reads graphs from files.
+  """
+  graph_path = os.path.join(FLAGS.model_dir,
+                            'classify_image_graph_def.optimized.pb')
+  if not tf.gfile.Exists(graph_path):
+    graph_path = os.path.join(FLAGS.model_dir,
+                              'classify_image_graph_def.batched.pb')
+    tensorflow_service.write_graph_def(
+        tensorflow_service.load_batched_graph_def(), graph_path)
+  input_size = tensorflow_service.MODEL_INPUT_SIZE
+  converter = tf.lite.TFLiteConverter.from_frozen_graph(
+      graph_path,
+      input_arrays=['batch_input'],
+      output_arrays=['batch_softmax'],
+      input_shapes={'batch_input': [1, input_size, input_size, 3]})
+  converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  converter.representative_dataset = tf.lite.RepresentativeDataset(
+      representative_dataset)
+  converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+  return converter.convert()
+
+
+def main(_):
+  if not tf.gfile.IsDirectory(FLAGS.representative_image_dir):
+    tf.logging.fatal('Directory does not exist %s',
+                     FLAGS.representative_image_dir)
+    return
+
+  tensorflow_service.maybe_download_and_extract()
+  tensorflow_service.optimize_graph()
+
+  tflite_output_file = FLAGS.tflite_output_file or os.path.join(
+      FLAGS.model_dir, 'inception_int8.tflite')
+  print('Converting the model to TF-Lite')
+  tflite_model = convert_to_tflite()
+  with tf.gfile.FastGFile(tflite_output_file, 'wb') as f:
+    f.write(tflite_model)
+  print('TF-Lite model saved to {}'.format(tflite_output_file))
+
+
+if __name__ == '__main__':
+  tf.app.run()